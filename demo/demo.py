@@ -33,7 +33,7 @@ with open(mydir + '/../demo_tebot_token.dat') as fh:
     mybot.set_token(fh.read().strip())
 
 
-@mybot.route(path=['/start', '/help'])
+@mybot.route(path=['/start', '/help'], cache=True)
 def start(**kwargs):
     mybot.send(dedent("""
                 <b>Hello, I'm using free Python library
@@ -3,11 +3,56 @@ import requests
 import logging
 import time
 import threading
+import json
+
+from collections import deque, OrderedDict
 
 logger = logging.getLogger('tebot')
 
 g = threading.local()
 
+_CHAT_ID_PLACEHOLDER = '\x00tebot_chat_id\x00'
+
+# payload fields, which refer to the current message and can not be replayed
+_MESSAGE_SPECIFIC_FIELDS = ('reply_to_message_id', 'message_id',
+                            'reply_parameters')
+
+
+class _InlineResults:
+    """
+    Lazily evaluated inline query results
+    """
+
+    def __init__(self, results, answer_kwargs):
+        self.created = time.monotonic()
+        self.answer_kwargs = answer_kwargs
+        self._iter = iter(results)
+        self._results = []
+        self._lock = threading.Lock()
+        self.failed = False
+
+    def page(self, offset, size):
+        """
+        Get results page
+
+        Returns: tuple (results, has_more)
+        """
+        with self._lock:
+            # fetch one extra result to know if there's a next page
+            while self._iter is not None and len(
+                    self._results) <= offset + size:
+                try:
+                    self._results.append(next(self._iter))
+                except StopIteration:
+                    self._iter = None
+                except:
+                    # the iterator is dead, results can not be reused
+                    self._iter = None
+                    self.failed = True
+                    raise
+            return self._results[offset:offset +
+                                 size], len(self._results) > offset + size
+
 
 class TeBot(neotasker.BackgroundIntervalWorker):
 
@@ -19,11 +64,20 @@ class TeBot(neotasker.BackgroundIntervalWorker):
         def inner(fn):
             methods = kwargs.get('methods', [])
             path = kwargs.get('path')
-            self.register_route(fn, path, methods)
+            self.register_route(fn,
+                                path,
+                                methods,
+                                cache=kwargs.get('cache', False),
+                                cache_ttl=kwargs.get('cache_ttl'))
 
         return inner
 
-    def register_route(self, fn, path=None, methods='command'):
+    def register_route(self,
+                       fn,
+                       path=None,
+                       methods='command',
+                       cache=False,
+                       cache_ttl=None):
         """
         Register route
 
@@ -31,8 +85,16 @@ class TeBot(neotasker.BackgroundIntervalWorker):
             fn: route function
             path: list of commands, string or list
             methods: "message" (message handler, can be only one), "command"
-                (default), "query" / "callback_query", "*" for all, string or
-                list
+                (default), "query" / "callback_query", "*" for all commands
+                and callback queries, "inline" / "inline_query",
+                "chosen_inline_result" and "edited_message" (can be only one
+                for each), string or list
+            cache: cache command responses (for routes, which send the same
+                response to all users). Only chat_id is replaced when cached
+                responses are sent, responses with message-specific fields
+                (e.g. reply_to_message_id) are not cached
+            cache_ttl: command response cache TTL (default: None - no
+                expiration, 0 - disable cache)
 
         """
         if not methods:
@@ -46,16 +108,34 @@ class TeBot(neotasker.BackgroundIntervalWorker):
                         'Can not register route with path for messages')
                 else:
                     self.handle_message = fn
+            if method in ('edited_message', 'chosen_inline_result'):
+                if path:
+                    raise ValueError(
+                        f'Can not register route with path for {method}')
+                elif method == 'edited_message':
+                    self.handle_edited_message = fn
+                else:
+                    self.handle_chosen_inline_result = fn
             if not isinstance(path, tuple) and not isinstance(path, list):
                 path = [path]
             if method in ('command', '*'):
                 for p in path:
                     self._command_routes[p] = fn
+                    if p is not None:
+                        self.clear_route_cache(p)
+                        if cache:
+                            self._cached_routes[p] = cache_ttl
+                        else:
+                            self._cached_routes.pop(p, None)
                     logger.debug(f'registered command route {p} -> {fn}')
             if method in ('query', 'callback_query', '*'):
                 for p in path:
                     self._query_routes[p] = fn
                     logger.debug(f'registered callback query route {p} -> {fn}')
+            if method in ('inline', 'inline_query'):
+                for p in path:
+                    self._inline_routes[p] = fn
+                    logger.debug(f'registered inline query route {p} -> {fn}')
 
     def handle_message(self, text, **kwargs):
         """
@@ -90,7 +170,11 @@ class TeBot(neotasker.BackgroundIntervalWorker):
             kwargs['chat_id'] = chat_id
             kwargs['payload'] = payload
             kwargs['method'] = 'command'
-            return fn(**kwargs)
+            if path[0] in self._cached_routes and len(path) == 1:
+                lang = payload.get('from', {}).get('language_code')
+                return self._exec_cached_route(fn, (path[0], lang), **kwargs)
+            else:
+                return fn(**kwargs)
 
     def handle_query(self, chat_id, query_id, data, payload, **kwargs):
         """
@@ -123,6 +207,119 @@ class TeBot(neotasker.BackgroundIntervalWorker):
                 result = {}
             return self.answer_query(query_id, **result)
 
+    def handle_edited_message(self, text, **kwargs):
+        """
+        Override to handle edited text messages
+
+        By default does nothing
+        """
+        pass
+
+    def handle_inline_query(self, query_id, query, offset, payload, **kwargs):
+        """
+        Override to handle inline queries
+
+        By default routes queries by the first word, results are cached and
+        paginated automatically
+        """
+        logger.debug(
+            f'handling inline query query_id: {query_id}, query: {query},'
+            + f' offset: {offset}, payload: {payload}')
+        path = query.split(' ', 1)
+        fn = self._inline_routes.get(path[0])
+        if fn is None:
+            fn = self._inline_routes.get(None)
+        if fn is None:
+            logger.error(f'No inline query handler for {path[0]}')
+            return None
+        key = (path[0] if path[0] in self._inline_routes else None,
+               self.normalize_inline_query(query))
+        user_id = payload.get('from', {}).get('id')
+        # personal results are cached for the user only
+        personal_key = key + (user_id,)
+        results = self._get_inline_cache(key)
+        if results is None:
+            results = self._get_inline_cache(personal_key)
+        if results is None:
+            kwargs['query_id'] = query_id
+            kwargs['query'] = query
+            kwargs['path'] = path[0]
+            try:
+                kwargs['query_string'] = path[1]
+            except:
+                kwargs['query_string'] = None
+            kwargs['payload'] = payload
+            kwargs['method'] = 'inline'
+            result = fn(**kwargs)
+            if result is None:
+                result = []
+            if isinstance(result, dict):
+                answer_kwargs = result.copy()
+                result = answer_kwargs.pop('results', [])
+                # results are paginated automatically
+                answer_kwargs.pop('next_offset', None)
+            else:
+                answer_kwargs = {}
+            results = self._put_inline_cache(
+                personal_key if answer_kwargs.get('is_personal') else key,
+                _InlineResults(result, answer_kwargs))
+        try:
+            offset = max(int(offset), 0) if offset else 0
+        except ValueError:
+            offset = 0
+        try:
+            page, has_more = results.page(offset, self.inline_page_size)
+        except:
+            self._evict_inline_cache(results)
+            raise
+        return self.answer_inline_query(
+            query_id,
+            page,
+            next_offset=str(offset + len(page)) if has_more else '',
+            **results.answer_kwargs)
+
+    def handle_chosen_inline_result(self, result_id, query, **kwargs):
+        """
+        Override to handle chosen inline results
+
+        By default does nothing
+        """
+        pass
+
+    def normalize_inline_query(self, query):
+        """
+        Normalize inline query text, used as the result cache key
+
+        By default strips extra whitespaces and lowers the case
+        """
+        return ' '.join(query.split()).casefold()
+
+    def clear_inline_cache(self):
+        """
+        Clear inline query result cache
+        """
+        with self._lock:
+            self._inline_cache.clear()
+
+    def clear_route_cache(self, path=None):
+        """
+        Clear command response cache
+
+        Args:
+            path: command path (default: clear all)
+        """
+        with self._lock:
+            # responses being recorded now are not stored after invalidation
+            if path is None:
+                self._route_cache_generation[None] = \
+                        self._route_cache_generation.get(None, 0) + 1
+                self._route_cache.clear()
+            else:
+                self._route_cache_generation[path] = \
+                        self._route_cache_generation.get(path, 0) + 1
+                for key in [k for k in self._route_cache if k[0] == path]:
+                    del self._route_cache[key]
+
     def on_message(self, msg):
         """
         Override to implement extended message handling
@@ -163,6 +360,45 @@ class TeBot(neotasker.BackgroundIntervalWorker):
                                  message_id=message_id,
                                  payload=query)
 
+    def on_edited_message(self, msg):
+        """
+        Override to implement extended edited message handling
+        """
+        logger.debug(f'handling edited message {msg}')
+        chat = msg.get('chat')
+        if not chat: return
+        chat_id = chat.get('id')
+        if not chat_id: return
+        g.chat_id = chat_id
+        return self.handle_edited_message(chat_id=chat_id,
+                                          text=msg.get('text', ''),
+                                          message_id=msg.get('message_id'),
+                                          payload=msg)
+
+    def on_inline_query(self, query):
+        """
+        Override to implement extended inline query handling
+        """
+        logger.debug(f'handling inline query {query}')
+        query_id = query.get('id')
+        if not query_id: return
+        g.inline_query_id = query_id
+        return self.handle_inline_query(query_id,
+                                        query.get('query', ''),
+                                        query.get('offset', ''),
+                                        payload=query)
+
+    def on_chosen_inline_result(self, result):
+        """
+        Override to implement extended chosen inline result handling
+        """
+        logger.debug(f'handling chosen inline result {result}')
+        return self.handle_chosen_inline_result(
+            result_id=result.get('result_id'),
+            query=result.get('query', ''),
+            inline_message_id=result.get('inline_message_id'),
+            payload=result)
+
     def set_token(self, token=None):
         """
         Set bot token
@@ -426,6 +662,25 @@ class TeBot(neotasker.BackgroundIntervalWorker):
             self._format_query_payload({'callback_query_id': query_id},
                                        **kwargs))
 
+    def answer_inline_query(self, query_id=None, results=None, **kwargs):
+        """
+        Answer inline query
+
+        Args:
+            query_id: inline query id
+            results: list of inline query results
+            other API args: passed as-is
+        """
+        if query_id is None:
+            query_id = g.inline_query_id
+        return self.call(
+            'answerInlineQuery',
+            self._format_query_payload(
+                {
+                    'inline_query_id': query_id,
+                    'results': list(results) if results else []
+                }, **kwargs))
+
     def get_file(self, file_id):
         """
         Get file object
@@ -491,6 +746,24 @@ class TeBot(neotasker.BackgroundIntervalWorker):
         self._lock = threading.RLock()
         self._command_routes = {}
         self._query_routes = {}
+        self._inline_routes = {}
+        self.inline_cache_size = 1000
+        self.inline_cache_ttl = 60
+        self.inline_page_size = 50
+        self._inline_cache = OrderedDict()
+        self._cached_routes = {}
+        self._route_cache = {}
+        self._route_cache_generation = {}
+        self.circuit_threshold = 5
+        self.circuit_timeout = 30
+        self.circuit_queue_size = 0
+        self.max_poll_delay = 60
+        self._circuit_state = 'closed'
+        self._circuit_failures = 0
+        self._circuit_opened = 0
+        self._circuit_queue = deque()
+        self._poll_failures = 0
+        self._poll_not_before = 0
         super().__init__(*args, **kwargs)
 
     def process_update(self, payload):
@@ -506,6 +779,15 @@ class TeBot(neotasker.BackgroundIntervalWorker):
         elif 'callback_query' in payload:
             self.supervisor.spawn(self.safe_exec, self.on_query,
                                   payload['callback_query'])
+        elif 'inline_query' in payload:
+            self.supervisor.spawn(self.safe_exec, self.on_inline_query,
+                                  payload['inline_query'])
+        elif 'chosen_inline_result' in payload:
+            self.supervisor.spawn(self.safe_exec, self.on_chosen_inline_result,
+                                  payload['chosen_inline_result'])
+        elif 'edited_message' in payload:
+            self.supervisor.spawn(self.safe_exec, self.on_edited_message,
+                                  payload['edited_message'])
 
     def safe_exec(self, fn, *args, **kwargs):
         try:
@@ -517,33 +799,100 @@ class TeBot(neotasker.BackgroundIntervalWorker):
     def run(self, **kwargs):
         if not self.__token:
             raise RuntimeError('token not provided')
-        result = self.call('getUpdates', {'offset': self._update_offset + 1})
+        if time.monotonic() < self._poll_not_before:
+            return
+        probe_at = self._get_circuit_probe_time()
+        if probe_at is not None and time.monotonic() < probe_at:
+            # the poll would be dropped, wait until the circuit allows a probe
+            self._poll_not_before = probe_at
+            return
+        try:
+            result = self.call('getUpdates',
+                               {'offset': self._update_offset + 1})
+        except requests.RequestException as e:
+            logger.warning(f'getUpdates failed: {e}')
+            result = None
         if result and 'result' in result:
+            self._poll_failures = 0
             for m in result['result']:
                 self.process_update(m)
         else:
             logger.warning('Invalid getUpdates result')
+            self._poll_failures += 1
+            self._poll_not_before = time.monotonic() + min(
+                2**(self._poll_failures - 1), self.max_poll_delay)
+            probe_at = self._get_circuit_probe_time()
+            if probe_at is not None:
+                self._poll_not_before = min(self._poll_not_before, probe_at)
+
+    def get_circuit_state(self):
+        """
+        Get API circuit breaker state
+
+        Returns: dict with "state" ("closed", "open" or "half-open"),
+            "failures" (consecutive failed calls) and "queued" (calls waiting
+            for the circuit to close)
+        """
+        with self._lock:
+            return {
+                'state': self._circuit_state,
+                'failures': self._circuit_failures,
+                'queued': len(self._circuit_queue)
+            }
 
     def call(self, func, payload=None, files=None, retry=None):
         """
         Call API method
-        
+
+        If API circuit is open, the call fails fast: "send*" calls are queued
+        (if circuit_queue_size is set) and sent after the circuit is closed,
+        other calls are dropped.
+
         Args:
             payload: API call payload
             files: files
             retry: False - do not retry, None - default retry, number - retry
                    interval
         """
+        if getattr(g, 'route_cache_record', None) is not None:
+            return self._record_call(func, payload, files, retry)
         logger.debug(f'Telegram API call {func}: {payload}')
-        if files:
-            r = requests.post(f'{self.__uri}/{func}',
-                              data=payload,
-                              files=files,
-                              timeout=self.timeout)
+        if not self._circuit_allow():
+            if func.startswith('send') and self.circuit_queue_size:
+                self._circuit_enqueue(func, payload, files)
+            else:
+                logger.warning(f'API circuit is open, {func} call dropped')
+            return None
+        try:
+            if files:
+                r = requests.post(f'{self.__uri}/{func}',
+                                  data=payload,
+                                  files=files,
+                                  timeout=self.timeout)
+            elif isinstance(payload, bytes):
+                # pre-encoded JSON
+                r = requests.post(
+                    f'{self.__uri}/{func}',
+                    data=payload,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=self.timeout)
+            else:
+                r = requests.post(f'{self.__uri}/{func}',
+                                  json=payload,
+                                  timeout=self.timeout)
+        except requests.RequestException:
+            self._circuit_failure()
+            raise
+        except:
+            # local errors (e.g. non-serializable payload) are not API
+            # failures, let the next call probe the API again
+            self._circuit_release()
+            raise
+        # 429 (flood control) means API is up, it's not counted as a failure
+        if r.status_code < 500:
+            self._circuit_success()
         else:
-            r = requests.post(f'{self.__uri}/{func}',
-                              json=payload,
-                              timeout=self.timeout)
+            self._circuit_failure()
         if r.ok:
             result = r.json()
             logger.debug(result)
@@ -556,12 +905,180 @@ class TeBot(neotasker.BackgroundIntervalWorker):
             logger.debug(r.text)
             if retry is False or (retry is None and not self.retry_interval):
                 return None
-            time.sleep(self.retry_interval if self.retry_interval else retry)
+            if self._circuit_state == 'open':
+                return None
+            delay = self.retry_interval if self.retry_interval else retry
+            if r.status_code == 429:
+                try:
+                    retry_after = r.json()['parameters']['retry_after']
+                except:
+                    retry_after = 0
+                # don't block the thread for the flood control period
+                if retry_after > delay:
+                    logger.warning(
+                        f'API flood control, {func} call dropped,'
+                        + f' retry after {retry_after} sec')
+                    return None
+            time.sleep(delay)
             return self.call(func=func,
                              payload=payload,
                              files=files,
                              retry=False)
 
+    def _exec_cached_route(self, fn, key, **kwargs):
+        with self._lock:
+            cached = self._route_cache.get(key)
+            if cached is not None and cached[0] and time.monotonic(
+            ) > cached[0]:
+                del self._route_cache[key]
+                cached = None
+        if cached is not None:
+            logger.debug(f'command response cache hit {key}')
+            cid = json.dumps(kwargs['chat_id']).encode()
+            for func, prefix, suffix in cached[1]:
+                self.call(func, prefix + cid + suffix)
+            return None
+        generation = self._get_route_cache_generation(key[0])
+        # record API calls made by the route, the response is cached only if
+        # all of them are successful and sent to the current chat
+        g.route_cache_record = []
+        try:
+            result = fn(**kwargs)
+            calls = g.route_cache_record
+        finally:
+            g.route_cache_record = None
+        # routes, which sent nothing, are called again next time
+        ttl = self._cached_routes.get(key[0])
+        if calls and ttl != 0:
+            with self._lock:
+                if key[0] in self._cached_routes and generation == \
+                        self._get_route_cache_generation(key[0]):
+                    self._route_cache[key] = (time.monotonic() + ttl
+                                              if ttl is not None else None,
+                                              calls)
+        return result
+
+    def _get_route_cache_generation(self, path):
+        with self._lock:
+            return (self._route_cache_generation.get(None, 0),
+                    self._route_cache_generation.get(path, 0))
+
+    def _record_call(self, func, payload, files, retry):
+        calls = g.route_cache_record
+        g.route_cache_record = None
+        result = self.call(func, payload, files, retry)
+        if result and not files and isinstance(
+                payload, dict) and payload.get('chat_id') == g.chat_id and \
+                not any(f in payload for f in _MESSAGE_SPECIFIC_FIELDS):
+            try:
+                body = json.dumps(
+                    dict(payload, chat_id=_CHAT_ID_PLACEHOLDER)).encode()
+                prefix, suffix = body.split(
+                    json.dumps(_CHAT_ID_PLACEHOLDER).encode())
+            except (TypeError, ValueError):
+                pass
+            else:
+                calls.append((func, prefix, suffix))
+                g.route_cache_record = calls
+        return result
+
+    def _get_circuit_probe_time(self):
+        with self._lock:
+            if self._circuit_state == 'open':
+                return self._circuit_opened + self.circuit_timeout
+            else:
+                return None
+
+    def _circuit_allow(self):
+        with self._lock:
+            if self._circuit_state == 'closed':
+                return True
+            elif self._circuit_state == 'open' and time.monotonic(
+            ) - self._circuit_opened >= self.circuit_timeout:
+                # let a single call through to probe the API
+                self._circuit_state = 'half-open'
+                logger.info('API circuit half-open, probing')
+                return True
+            else:
+                return False
+
+    def _circuit_failure(self):
+        with self._lock:
+            self._circuit_failures += 1
+            if self._circuit_state == 'half-open' or (
+                    self._circuit_state == 'closed' and
+                    self.circuit_threshold and
+                    self._circuit_failures >= self.circuit_threshold):
+                self._circuit_state = 'open'
+                self._circuit_opened = time.monotonic()
+                logger.error('API circuit open')
+
+    def _circuit_release(self):
+        with self._lock:
+            if self._circuit_state == 'half-open':
+                self._circuit_state = 'open'
+
+    def _circuit_success(self):
+        with self._lock:
+            self._circuit_failures = 0
+            if self._circuit_state == 'closed':
+                return
+            self._circuit_state = 'closed'
+            logger.info('API circuit closed')
+            flush = bool(self._circuit_queue)
+        if flush:
+            self.supervisor.spawn(self._flush_circuit_queue)
+
+    def _circuit_enqueue(self, func, payload, files):
+        with self._lock:
+            if len(self._circuit_queue) >= self.circuit_queue_size:
+                dropped = self._circuit_queue.popleft()
+                logger.warning(
+                    f'API circuit queue is full, {dropped[0]} call dropped')
+            self._circuit_queue.append((func, payload, files))
+            logger.info(f'API circuit is open, {func} call queued')
+
+    def _flush_circuit_queue(self):
+        while True:
+            with self._lock:
+                if self._circuit_state != 'closed' or not self._circuit_queue:
+                    return
+                func, payload, files = self._circuit_queue.popleft()
+            self.safe_exec(self.call, func, payload, files)
+
+    def _get_inline_cache(self, key):
+        with self._lock:
+            results = self._inline_cache.get(key)
+            if results is None:
+                return None
+            elif results.failed or time.monotonic(
+            ) - results.created > self.inline_cache_ttl:
+                del self._inline_cache[key]
+                return None
+            else:
+                self._inline_cache.move_to_end(key)
+                return results
+
+    def _evict_inline_cache(self, results):
+        with self._lock:
+            for key in [
+                    k for k, v in self._inline_cache.items() if v is results
+            ]:
+                del self._inline_cache[key]
+
+    def _put_inline_cache(self, key, results):
+        with self._lock:
+            if not self.inline_cache_size or not self.inline_cache_ttl:
+                return results
+            # keep results computed by a concurrent query
+            cached = self._get_inline_cache(key)
+            if cached is not None:
+                return cached
+            self._inline_cache[key] = results
+            while len(self._inline_cache) > self.inline_cache_size:
+                self._inline_cache.popitem(last=False)
+            return results
+
     def _format_payload(self, payload, **kwargs):
         payload.update(kwargs)
         if 'reply_markup' in payload: